@@ -1,6 +1,64 @@
 import pandas as pd
 import numpy as np
 
+# Sort key standing in for missing dates, so they sort last as with sort_values
+_MISSING_DATE_KEY = np.iinfo(np.int64).max
+
+# Flag codes used while flagging, decoded to labels through _FLAG_LABELS
+_DUPLICATE, _REFERENCE, _TARGET, _OTHER = range(4)
+_FLAG_LABELS = np.array(['duplicate', 'reference', 'target', 'other'], dtype=object)
+
+# Candidate claim_received_date formats, tried in order on a sample of the column
+_DATE_FORMATS = ['ISO8601', '%m/%d/%Y', '%d/%m/%Y']
+_DATE_SAMPLE_SIZE = 100
+
+def _guess_date_format(values):
+    """
+    Picks the candidate format that parses the most of a sample of values, falling
+    back to per-element 'mixed' parsing when none of them parses any.
+    """
+    sample = values.dropna().head(_DATE_SAMPLE_SIZE)
+    parsed = {
+        fmt: pd.to_datetime(sample, format=fmt, errors='coerce').notna().sum()
+        for fmt in _DATE_FORMATS
+    }
+    best = max(_DATE_FORMATS, key=parsed.get)
+    return best if parsed[best] else 'mixed'
+
+def _flag_groups(dates, keys):
+    """
+    Flags rows from their datetime64 dates (naive or tz-aware, compared as UTC) and
+    grouping keys, aggregating each group's size and first and last date in one
+    pass and broadcasting them back to its rows by group id.
+    """
+    is_missing = dates.isna().to_numpy()
+    sort_keys = pd.Series(
+        np.where(is_missing, _MISSING_DATE_KEY, dates.to_numpy(dtype='datetime64[ns]').view('i8')),
+        index=dates.index
+    )
+    grouped = sort_keys.groupby(keys, observed=True, sort=False)
+    bounds = grouped.agg(['size', 'min', 'max'])
+    group_ids = grouped.ngroup()
+
+    # Rows with a missing key belong to no group (NaN id) and stay 'other'
+    in_group = group_ids.notna().to_numpy()
+    ids = group_ids[in_group].to_numpy(dtype=np.int64)
+    row_keys = sort_keys.to_numpy()[in_group]
+    has_pair = bounds['size'].to_numpy()[ids] > 1
+    first_keys = bounds['min'].to_numpy()[ids]
+    last_keys = bounds['max'].to_numpy()[ids]
+    is_dated = ~is_missing[in_group]
+
+    is_duplicate = has_pair & (first_keys == last_keys) & (last_keys != _MISSING_DATE_KEY)
+    is_first = has_pair & is_dated & (row_keys == first_keys)
+    is_last = has_pair & is_dated & (row_keys == last_keys)
+
+    codes = np.full(len(in_group), _OTHER, dtype=np.int8)
+    codes[in_group] = np.where(
+        is_duplicate, _DUPLICATE, np.where(is_first, _REFERENCE, np.where(is_last, _TARGET, _OTHER))
+    )
+    return np.take(_FLAG_LABELS, codes)
+
 def add_proc_code_flag(df):
     """
     Adds 'proc_code_flag' and 'target_code' columns to the input DataFrame using
@@ -8,11 +66,16 @@ def add_proc_code_flag(df):
     """
     # Data preparation
     df['plan_paid_amount'] = df['plan_paid_amount'].astype(float)
-    df['claim_received_date'] = pd.to_datetime(df['claim_received_date'], errors='coerce')
+    df['claim_received_date'] = pd.to_datetime(
+        df['claim_received_date'],
+        format=_guess_date_format(df['claim_received_date']),
+        errors='coerce'
+    )
 
     modifier_cols = ['proc_modifier', 'proc_modifier2', 'proc_modifier4', 'proc_modifier5']
     df['procedure_code'] = df['procedure_code'].str.strip()
-    df[modifier_cols] = df[modifier_cols].fillna('').apply(lambda x: x.str.strip().str.lower())
+    for col in modifier_cols:
+        df[col] = df[col].fillna('').str.strip().str.lower()
     df['quantity'] = pd.to_numeric(df['quantity'], errors='coerce')
 
     # Grouping keys
@@ -26,36 +89,27 @@ def add_proc_code_flag(df):
         'quantity'
     ]
 
-    # Flagging logic per group
-    def flag_by_procedure(group):
-        group = group[group['plan_paid_amount'] > 75].sort_values('claim_received_date')
-        if group.empty or len(group) == 1:
-            return pd.Series(['other'] * len(group), index=group.index)
-
-        first_date = group.iloc[0]['claim_received_date']
-        last_date = group.iloc[-1]['claim_received_date']
-
-        flags = []
-        for _, row in group.iterrows():
-            if first_date == last_date:
-                flags.append('duplicate')
-            elif row['claim_received_date'] == first_date:
-                flags.append('reference')
-            elif row['claim_received_date'] == last_date:
-                flags.append('target')
-            else:
-                flags.append('other')
-        return pd.Series(flags, index=group.index)
+    # Flagging logic, vectorized over all groups
+    is_candidate = df['plan_paid_amount'] > 75
+    candidates = df[is_candidate]
+    dates = candidates['claim_received_date']
+    # Group on categorical codes instead of re-hashing the string keys
+    string_keys = ['member_medicare_id', 'procedure_code', *modifier_cols]
+    keys = [
+        candidates[key].astype('category') if key in string_keys else candidates[key]
+        for key in group_keys
+    ]
+    flags = _flag_groups(dates, keys)
 
     # Apply flagging
-    flags_series = df.groupby(group_keys, group_keys=False).apply(flag_by_procedure)
     df['proc_code_flag'] = 'other'
-    df.loc[flags_series.index, 'proc_code_flag'] = flags_series
+    df.loc[is_candidate, 'proc_code_flag'] = flags
 
     # Add target_code
-    df['target_code'] = df.apply(
-        lambda row: row['procedure_code'] if row['proc_code_flag'] in ['target', 'duplicate'] else np.nan,
-        axis=1
+    df['target_code'] = np.where(
+        df['proc_code_flag'].isin(['target', 'duplicate']),
+        df['procedure_code'],
+        np.nan
     )
 
     return df
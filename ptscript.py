@@ -1,13 +1,44 @@
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
 import boto3
-import io
+import csv
+import time
+from botocore.config import Config
 from datetime import datetime
+from functools import lru_cache
 
 # Constants
 REGION = 'us-east-1'
 SOURCE_DB = 'devoted_health_prod'
 QUERY_OUTPUT_LOCATION = 's3://zignaai-deidentified-claimsdata/query output/'
 WORKGROUP_NAME = 'SelectionQueries-Production'
+POLL_INITIAL_DELAY = 0.2  # seconds
+POLL_MAX_DELAY = 5.0  # seconds
+CSV_BLOCK_SIZE = 8 << 20  # bytes per parallel parse block
+
+# Shared session and client config, so repeated calls reuse service models and connections
+_SESSION = boto3.session.Session()
+_CLIENT_CONFIG = Config(retries={'mode': 'adaptive', 'max_attempts': 10}, max_pool_connections=20)
+# Bounded so rotated credentials and their clients are evicted rather than kept for the process lifetime
+_CLIENT_CACHE_SIZE = 8
+
+@lru_cache(maxsize=_CLIENT_CACHE_SIZE)
+def _get_client(service_name, aws_access_key_id, aws_secret_access_key):
+    """
+    Return a boto3 client for the given service and credentials, cached across calls
+    for the most recently used credential pairs.
+    
+    Args:
+        service_name (str): boto3 service name, e.g. 'athena' or 's3'
+        aws_access_key_id (str): AWS access key ID for authentication
+        aws_secret_access_key (str): AWS secret access key for authentication
+    
+    Returns:
+        botocore.client.BaseClient: Client built from the shared session and config
+    """
+    return _SESSION.client(service_name, region_name=REGION, config=_CLIENT_CONFIG,
+                           aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
 
 def run_query(athena_client, s3_client, query_string, source_db, query_output_location, workgroup):
     """
@@ -33,19 +64,36 @@ def run_query(athena_client, s3_client, query_string, source_db, query_output_lo
         )
         query_execution_id = response['QueryExecutionId']
         
+        delay = POLL_INITIAL_DELAY
         while True:
             query_status = athena_client.get_query_execution(QueryExecutionId=query_execution_id)
             query_state = query_status['QueryExecution']['Status']['State']
             if query_state in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
                 break
+            time.sleep(delay)
+            delay = min(delay * 1.5, POLL_MAX_DELAY)
         
         if query_state == 'SUCCEEDED':
             try:
                 query_result_path = query_status['QueryExecution']['ResultConfiguration']['OutputLocation']
                 bucket = query_result_path.split('//')[1].split('/')[0]
                 key = '/'.join(query_result_path.split('//')[1].split('/')[1:])
-                buffer = io.BytesIO(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
-                df = pd.read_csv(buffer, dtype=str)
+                # Stream the object body straight into the parser instead of buffering it first
+                result_object = s3_client.get_object(Bucket=bucket, Key=key)
+                with result_object['Body'] as body:
+                    # Take the column names from the header line and read every column as a
+                    # string, as Athena writes them, so keys keep their leading zeros
+                    header = body.readline()
+                    column_names = next(csv.reader([header.decode('utf-8')]))
+                    if len(header) < result_object['ContentLength']:
+                        table = pv.read_csv(body,
+                                            read_options=pv.ReadOptions(use_threads=True, block_size=CSV_BLOCK_SIZE, column_names=column_names),
+                                            convert_options=pv.ConvertOptions(column_types={name: pa.string() for name in column_names},
+                                                                              strings_can_be_null=True))
+                    else:
+                        # Header-only result: pyarrow rejects the empty remainder, so build the empty table directly
+                        table = pa.table({name: pa.array([], type=pa.string()) for name in column_names})
+                df = table.to_pandas(self_destruct=True)
                 return df
             except Exception as e:
                 print("QUERY EXECUTION SUCCESSFUL BUT GOT ERROR WHILE CONVERSION TO DATAFRAME")
@@ -95,55 +143,69 @@ def add_proc_code_flag(df, aws_access_key_id, aws_secret_access_key):
     lookback_date = (current_date - pd.DateOffset(months=18)).replace(day=1).strftime("'%Y-%m-%d'")
     
     # Construct the query string
-    query_string = f"""SELECT distinct p1.payer_control_number,
-            p1.member_medicare_id,
-            p1.rendering_provider_npi,
-            p1.service_date,
-            array_intersect(
-                array_distinct(array_agg(p1.procedure_code)),
-                array_distinct(array_agg(column1))
-            ) as ref_intersect,
-            array_intersect(
-                array_distinct(array_agg(p2.procedure_code)),
-                array_distinct(array_agg(column2))
-            ) as target_intersect
-        FROM devoted_health_prod.transformed_claims AS p1
-            JOIN devoted_health_prod.transformed_claims AS p2 ON p1.payer_control_number = p2.payer_control_number
-            and p1.member_medicare_id = p2.member_medicare_id
-            AND p1.rendering_provider_npi = p2.rendering_provider_npi
-            AND p1.service_date = p2.service_date
-            LEFT JOIN zigna_reference_data.medicare_ncci_ptp_edits on p1.procedure_code = medicare_ncci_ptp_edits.column1
-            AND p2.procedure_code = medicare_ncci_ptp_edits.column2
-        where p1.bill_type_code is null
-            and p1.first_service_date >= effective_date
-            and p1.first_service_date < deletion_date
-            AND p1.plan_paid_amount > 0
-            AND p2.plan_paid_amount >= 74
-            AND modifier_filter = '0'
-            AND p1.procedure_code <> p2.procedure_code
-            AND medicare_ncci_ptp_edits.provider_type in ('practitioner')
-            AND p1.payment_effective_date >= date({lookback_date})
-            AND p1.is_final_paid_indicator = 1
-        group by p1.payer_control_number,
-            p1.member_medicare_id,
-            p1.service_date,
-            p1.rendering_provider_npi
-        having cardinality(
+    query_string = f"""WITH intersects AS (
+            SELECT p1.payer_control_number,
+                p1.member_medicare_id,
+                p1.rendering_provider_npi,
+                p1.service_date,
                 array_intersect(
                     array_distinct(array_agg(p1.procedure_code)),
                     array_distinct(array_agg(column1))
-                )
-            ) >= 1
-            and cardinality(
+                ) as ref_intersect,
                 array_intersect(
                     array_distinct(array_agg(p2.procedure_code)),
                     array_distinct(array_agg(column2))
-                )
-            ) >= 1"""
+                ) as target_intersect
+            FROM (
+                    SELECT payer_control_number,
+                        member_medicare_id,
+                        rendering_provider_npi,
+                        service_date,
+                        procedure_code,
+                        first_service_date
+                    FROM devoted_health_prod.transformed_claims
+                    where bill_type_code is null
+                        AND plan_paid_amount > 0
+                        AND payment_effective_date >= date({lookback_date})
+                        AND is_final_paid_indicator = 1
+                ) AS p1
+                JOIN (
+                    SELECT payer_control_number,
+                        member_medicare_id,
+                        rendering_provider_npi,
+                        service_date,
+                        procedure_code
+                    FROM devoted_health_prod.transformed_claims
+                    where plan_paid_amount >= 74
+                ) AS p2 ON p1.payer_control_number = p2.payer_control_number
+                and p1.member_medicare_id = p2.member_medicare_id
+                AND p1.rendering_provider_npi = p2.rendering_provider_npi
+                AND p1.service_date = p2.service_date
+                LEFT JOIN zigna_reference_data.medicare_ncci_ptp_edits on p1.procedure_code = medicare_ncci_ptp_edits.column1
+                AND p2.procedure_code = medicare_ncci_ptp_edits.column2
+            where p1.first_service_date >= effective_date
+                and p1.first_service_date < deletion_date
+                AND modifier_filter = '0'
+                AND p1.procedure_code <> p2.procedure_code
+                AND medicare_ncci_ptp_edits.provider_type in ('practitioner')
+            group by p1.payer_control_number,
+                p1.member_medicare_id,
+                p1.service_date,
+                p1.rendering_provider_npi
+        )
+        SELECT payer_control_number,
+            member_medicare_id,
+            rendering_provider_npi,
+            service_date,
+            ref_intersect,
+            target_intersect
+        FROM intersects
+        where cardinality(ref_intersect) >= 1
+            and cardinality(target_intersect) >= 1"""
     
     # Initialize boto3 clients with provided AWS credentials
-    s3_client = boto3.client('s3', region_name=REGION, aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
-    athena_client = boto3.client('athena', region_name=REGION, aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
+    s3_client = _get_client('s3', aws_access_key_id, aws_secret_access_key)
+    athena_client = _get_client('athena', aws_access_key_id, aws_secret_access_key)
     
     # Fetch reference data
     referance_data = run_query(athena_client, s3_client, query_string, SOURCE_DB, 
@@ -154,34 +216,32 @@ def add_proc_code_flag(df, aws_access_key_id, aws_secret_access_key):
     
     # Clean reference data
     df_target_ref_clean = referance_data.copy()
-    df_target_ref_clean['ref_intersect'] = df_target_ref_clean['ref_intersect'].str.replace('[', '').str.replace(']', '')
-    df_target_ref_clean['ref_intersect'] = df_target_ref_clean['ref_intersect'].str.split(',')
-    df_target_ref_clean['ref_intersect'] = df_target_ref_clean['ref_intersect'].apply(lambda x: [i.strip() for i in x])
-    
-    df_target_ref_clean['target_intersect'] = df_target_ref_clean['target_intersect'].str.replace('[', '').str.replace(']', '')
-    df_target_ref_clean['target_intersect'] = df_target_ref_clean['target_intersect'].str.split(',')
-    df_target_ref_clean['target_intersect'] = df_target_ref_clean['target_intersect'].apply(lambda x: [i.strip() for i in x])
+    for col in ('ref_intersect', 'target_intersect'):
+        # '[A, B]' -> ['A', 'B'] in one regex pass plus one split
+        df_target_ref_clean[col] = df_target_ref_clean[col].fillna('').str.replace(r'[\[\]\s]', '', regex=True).str.split(',')
     
     # Merge with input dataframe
-    main_df_with_target_ref_codes = df.merge(df_target_ref_clean, 
-                                            on=['payer_control_number', 'member_medicare_id', 
-                                                'service_date', 'rendering_provider_npi'],
-                                            how='left')
-    
-    # Handle NaN values
-    main_df_with_target_ref_codes['target_intersect'] = main_df_with_target_ref_codes['target_intersect'].apply(lambda x: [''] if pd.isna(x) else x)
-    main_df_with_target_ref_codes['ref_intersect'] = main_df_with_target_ref_codes['ref_intersect'].apply(lambda x: [''] if pd.isna(x) else x)
-    
-    # Define flagging function
-    def flag_row(row):
-        if row['procedure_code'] in row['ref_intersect']:
-            return 'reference'
-        elif row['procedure_code'] in row['target_intersect']:
-            return 'target'
-        else:
-            return 'other'
-    
-    # Apply flagging
-    main_df_with_target_ref_codes['proc_code_flag'] = main_df_with_target_ref_codes.apply(flag_row, axis=1)
+    join_keys = ['payer_control_number', 'member_medicare_id', 'service_date', 'rendering_provider_npi']
+    list_cols = ['ref_intersect', 'target_intersect']
+    main_df_with_target_ref_codes = df.merge(df_target_ref_clean[join_keys + list_cols], on=join_keys, how='left', sort=False)
+    
+    # Fill unmatched rows' lists with [''] for the returned frame; flagging uses the lookup below
+    main_df_with_target_ref_codes['target_intersect'] = main_df_with_target_ref_codes['target_intersect'].apply(lambda x: x if isinstance(x, list) else [''])
+    main_df_with_target_ref_codes['ref_intersect'] = main_df_with_target_ref_codes['ref_intersect'].apply(lambda x: x if isinstance(x, list) else [''])
+    
+    # Build a long-format (join keys, procedure_code) -> flag lookup from the lists
+    lookups = []
+    for col, flag in (('ref_intersect', 'reference'), ('target_intersect', 'target')):
+        lookups.append(df_target_ref_clean[join_keys + [col]]
+                       .explode(col)
+                       .rename(columns={col: 'procedure_code'})
+                       .assign(proc_code_flag=flag))
+    # A code in both lists is flagged as reference
+    flag_lookup = pd.concat(lookups, ignore_index=True).drop_duplicates(join_keys + ['procedure_code'])
+    
+    # Apply flagging with a single hash merge over the key columns only; the lookup is
+    # unique on its keys, so the left merge keeps the row order of the main frame
+    flags = main_df_with_target_ref_codes[join_keys + ['procedure_code']].merge(flag_lookup, on=join_keys + ['procedure_code'], how='left', sort=False)
+    main_df_with_target_ref_codes['proc_code_flag'] = flags['proc_code_flag'].fillna('other').to_numpy()
     
     return main_df_with_target_ref_codes
\ No newline at end of file